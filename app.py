@@ -1,10 +1,24 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi.responses import StreamingResponse
+import asyncio
+import io
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pa_csv
 import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timezone
 from pathlib import Path
 import os
 from google import genai
+from google.genai import errors
+from aiolimiter import AsyncLimiter
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 from pymongo import MongoClient
 
 #------------MongoDB connect--------------
@@ -32,6 +46,70 @@ LOG_DIR.mkdir(exist_ok=True)
 
 LOG_FILE = LOG_DIR / "llm_product_tracking.jsonl"
 
+# Number of uvicorn worker processes (uvicorn reads the same variable). Each
+# worker re-runs this module's import-time setup, including the MongoDB lookup
+# and semantic cache load. Each worker also keeps its own answer caches and
+# limits; nothing below is shared between workers.
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# Gemini quota for the API key, split evenly across the worker processes.
+# Defaults are the free-tier limits for gemini-2.5-flash and
+# gemini-embedding-001 (https://ai.google.dev/gemini-api/docs/rate-limits);
+# set them to the key's actual tier.
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "10"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "250000"))
+GEMINI_EMBEDDING_RPM = int(os.getenv("GEMINI_EMBEDDING_RPM", "100"))
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "8"))
+
+LLM_CONCURRENCY = max(1, GEMINI_CONCURRENCY // WEB_CONCURRENCY)
+llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+llm_rate_limiter = AsyncLimiter(max(1, GEMINI_RPM // WEB_CONCURRENCY), 60)
+embedding_rate_limiter = AsyncLimiter(max(1, GEMINI_EMBEDDING_RPM // WEB_CONCURRENCY), 60)
+RETRYABLE_STATUS_CODES = {429, 503}
+
+# Large uploads are dispatched in bounded batches of distinct prompts, and
+# Gemini calls are held to this worker's share of the tokens-per-minute quota
+LLM_BATCH_SIZE = 256
+LLM_TOKENS_PER_MINUTE = max(1, GEMINI_TPM // WEB_CONCURRENCY)
+# Conservative allowance for the response (including thinking) of one call
+LLM_OUTPUT_TOKENS_ESTIMATE = 1024
+token_window_start = 0.0
+token_window_used = 0
+
+# In-process cache of Gemini answers keyed by (use_case, source, target, status)
+LLM_CACHE_MAXSIZE = 4096
+LLM_CACHE_TTL = 3600
+llm_cache = OrderedDict()
+
+PROMPT_TEMPLATE = (
+    "\nUse case: {use_case}\nSource: {source}\nTarget: {target}\nStatus: {status}\n"
+    "\nExplain the resolution clearly for an admin.\n"
+)
+
+logger = logging.getLogger(__name__)
+
+# Persistent embedding cache for near-duplicate prompts. Lookups only compare
+# prompts with the same (use_case, status), since prompts differing in those
+# fields embed close together but need different answers. Entries expire with
+# the same TTL as llm_cache, and each scope keeps only its newest entries.
+EMBEDDING_MODEL = "models/gemini-embedding-001"
+EMBEDDING_CONCURRENCY = LLM_CONCURRENCY
+embedding_semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+SEMANTIC_CACHE_THRESHOLD = 0.97
+SEMANTIC_CACHE_TTL = LLM_CACHE_TTL
+SEMANTIC_CACHE_SCOPE_MAXSIZE = 512
+SEMANTIC_CACHE_DB = LOG_DIR / "semantic_cache.sqlite3"
+
+semantic_db = sqlite3.connect(SEMANTIC_CACHE_DB, timeout=5, check_same_thread=False)
+semantic_db.execute(
+    "CREATE TABLE IF NOT EXISTS semantic_answers "
+    "(use_case TEXT, status TEXT, prompt TEXT, embedding BLOB, response TEXT, created_at REAL)"
+)
+# Serializes writes to semantic_db from worker threads
+semantic_db_lock = threading.Lock()
+# (use_case, status) -> SemanticScope
+semantic_index = {}
+
 
 USE_CASES = {
     "CSV Upload Validation",
@@ -166,110 +244,363 @@ VALIDATION_CASES = {
 }
 
 PROCESS_CASES = USE_CASES - RECONCILIATION_CASES - VALIDATION_CASES
-def handle_use_case_row(row):
-    use_case = row["use_case"]
-
-    if use_case not in USE_CASES:
-        return {
-            "use_case": use_case,
-            "status": "INVALID_USE_CASE",
-            "severity": "HIGH",
-        }
-
-    if use_case in RECONCILIATION_CASES:
-        sent = int(row.get("sent", 0))
-        received = int(row.get("received", 0))
-        diff = sent - received
-        status = "MATCH" if diff == 0 else "MISMATCH"
-        severity = "HIGH" if diff != 0 else "NONE"
-
-    elif use_case in VALIDATION_CASES:
-        sent = received = diff = 0
-        status = "VALIDATION_REQUIRED"
-        severity = "MEDIUM"
-
-    else:
-        sent = received = diff = 0
-        status = "PROCESS_EVENT"
-        severity = "MEDIUM"
-
-    return {
-        "use_case": use_case,
-        "source": row.get("source", ""),
-        "target": row.get("target", ""),
-        "sent": sent,
-        "received": received,
-        "difference": diff,
-        "status": status,
-        "severity": severity,
-        "metadata": row.get("metadata", ""),
-    }
-def generate_llm_solution(result):
-    prompt = f"""
-Use case: {result['use_case']}
-Source: {result['source']}
-Target: {result['target']}
-Status: {result['status']}
-
-Explain the resolution clearly for an admin.
-"""
 
+_CSV_UPLOAD_SOLUTION = USE_CASE_SOLUTIONS["CSV Upload Validation"]
+
+FALLBACK_SOLUTIONS = {
+    uc: "LLM unavailable due to quota or rate limits. Suggested action: "
+        + USE_CASE_SOLUTIONS.get(uc, "Manual review required.")
+    for uc in USE_CASES
+}
+
+USE_CASE_KIND = {
+    uc: (
+        "recon" if uc in RECONCILIATION_CASES
+        else "validation" if uc in VALIDATION_CASES
+        else "process"
+    )
+    for uc in USE_CASES
+}
+
+
+INPUT_COLUMNS = ["use_case", "source", "target", "sent", "received", "metadata"]
+# "row" is the 0-based position of the record in the uploaded CSV, since
+# streamed results do not come back in input order
+RESULT_COLUMNS = [
+    "row", "use_case", "source", "target", "sent", "received",
+    "difference", "status", "severity", "metadata",
+]
+INVALID_RESULT_COLUMNS = ["row", "use_case", "status", "severity"]
+PROMPT_KEY_COLUMNS = ["use_case", "source", "target", "status"]
+TEXT_COLUMNS = ["use_case", "source", "target", "metadata"]
+
+
+def read_upload_csv(source):
+    """Parse an uploaded CSV with Arrow's multithreaded reader.
+
+    Text columns are pinned to strings so dates, timestamps and numeric IDs
+    come back exactly as uploaded instead of being type-inferred.
+    """
+    convert_options = pa_csv.ConvertOptions(
+        column_types={col: pa.string() for col in TEXT_COLUMNS}
+    )
+    return pa_csv.read_csv(source, convert_options=convert_options).to_pandas()
+
+
+def normalize_frame(df):
+    """Reindex to INPUT_COLUMNS and fill the defaults for missing cells."""
+    df = df.reindex(columns=INPUT_COLUMNS)
+    for col in ("source", "target", "metadata"):
+        df[col] = df[col].fillna("").astype(str)
+    for col in ("sent", "received"):
+        # float64 first so unparseable values are real NaN that fillna replaces
+        df[col] = (
+            pd.to_numeric(df[col], errors="coerce")
+            .astype("float64").fillna(0).astype(np.int64)
+        )
+    return df
+
+
+def classify_frame(df):
+    df = normalize_frame(df)
+    df["row"] = np.arange(len(df))
+
+    kind = df["use_case"].map(USE_CASE_KIND)
+    valid = kind.notna().to_numpy()
+    recon = kind.eq("recon").to_numpy()
+    validation = kind.eq("validation").to_numpy()
+
+    sent = df["sent"].to_numpy(dtype=np.int64)
+    received = df["received"].to_numpy(dtype=np.int64)
+    diff = np.where(recon, sent - received, 0)
+
+    df["status"] = np.where(
+        ~valid, "INVALID_USE_CASE",
+        np.where(
+            recon, np.where(diff == 0, "MATCH", "MISMATCH"),
+            np.where(validation, "VALIDATION_REQUIRED", "PROCESS_EVENT")
+        )
+    )
+    df["severity"] = np.where(
+        ~valid | (diff != 0), "HIGH",
+        np.where(recon, "NONE", "MEDIUM")
+    )
+    df["sent"] = np.where(recon, sent, 0)
+    df["received"] = np.where(recon, received, 0)
+    df["difference"] = diff
+
+    return df[RESULT_COLUMNS]
+
+
+def llm_cache_key(result):
+    return tuple(result[col] for col in PROMPT_KEY_COLUMNS)
+
+
+def is_retryable(exc):
+    return isinstance(exc, errors.APIError) and exc.code in RETRYABLE_STATUS_CODES
+
+
+@retry(
+    retry=retry_if_exception(is_retryable),
+    wait=wait_exponential_jitter(initial=1, max=16),
+    stop=stop_after_attempt(3),
+    reraise=True
+)
+async def generate_with_retry(**kwargs):
+    async with llm_rate_limiter, llm_semaphore:
+        return await client.aio.models.generate_content(
+            model="models/gemini-2.5-flash", **kwargs
+        )
+
+
+def estimate_tokens(prompt):
+    return len(prompt) // 4 + LLM_OUTPUT_TOKENS_ESTIMATE
+
+
+async def reserve_tokens(estimated):
+    """Wait until the current one-minute window can absorb `estimated` tokens."""
+    global token_window_start, token_window_used
+    while True:
+        # No await between the check and the update, so this is atomic on the loop
+        now = time.monotonic()
+        if now - token_window_start >= 60:
+            token_window_start = now
+            token_window_used = 0
+        # An empty window always admits one call, however large
+        if not token_window_used or token_window_used + estimated <= LLM_TOKENS_PER_MINUTE:
+            token_window_used += estimated
+            return
+        await asyncio.sleep(60 - (now - token_window_start))
+
+
+class SemanticScope:
+    """Ring buffer of unit-length embeddings and answers for one (use_case, status)."""
+
+    def __init__(self, dim):
+        self.embeddings = np.empty((0, dim), dtype=np.float32)
+        self.created_at = np.empty(0)
+        self.responses = []
+        self.oldest = 0
+
+    def add(self, embedding, response, created_at):
+        size = len(self.responses)
+        if size < SEMANTIC_CACHE_SCOPE_MAXSIZE:
+            if size == len(self.created_at):
+                capacity = min(max(2 * size, 16), SEMANTIC_CACHE_SCOPE_MAXSIZE)
+                self.embeddings = np.resize(self.embeddings, (capacity, self.embeddings.shape[1]))
+                self.created_at = np.resize(self.created_at, capacity)
+            slot = size
+            self.responses.append(response)
+        else:
+            # Full: overwrite the oldest entry
+            slot = self.oldest
+            self.oldest = (slot + 1) % SEMANTIC_CACHE_SCOPE_MAXSIZE
+            self.responses[slot] = response
+        self.embeddings[slot] = embedding
+        self.created_at[slot] = created_at
+
+    def get(self, embedding, now):
+        size = len(self.responses)
+        scores = self.embeddings[:size] @ embedding
+        scores[self.created_at[:size] < now - SEMANTIC_CACHE_TTL] = -np.inf
+        best = int(np.argmax(scores))
+        if scores[best] >= SEMANTIC_CACHE_THRESHOLD:
+            return self.responses[best]
+        return None
+
+
+def semantic_index_add(scope, embedding, response, created_at):
+    if scope not in semantic_index:
+        semantic_index[scope] = SemanticScope(embedding.size)
+    semantic_index[scope].add(embedding, response, created_at)
+
+
+def load_semantic_index():
+    cutoff = time.time() - SEMANTIC_CACHE_TTL
+    semantic_db.execute("DELETE FROM semantic_answers WHERE created_at < ?", (cutoff,))
+    semantic_db.commit()
+    rows = semantic_db.execute(
+        "SELECT use_case, status, embedding, response, created_at "
+        "FROM semantic_answers ORDER BY created_at"
+    ).fetchall()
+    for use_case, status, embedding, response, created_at in rows:
+        semantic_index_add(
+            (use_case, status), np.frombuffer(embedding, dtype=np.float32),
+            response, created_at
+        )
+
+
+load_semantic_index()
+
+
+def semantic_cache_get(scope, embedding):
+    if scope not in semantic_index:
+        return None
+    return semantic_index[scope].get(embedding, time.time())
+
+
+def _semantic_db_insert(scope, prompt, embedding, response, created_at):
+    with semantic_db_lock:
+        semantic_db.execute(
+            "DELETE FROM semantic_answers WHERE created_at < ?",
+            (created_at - SEMANTIC_CACHE_TTL,)
+        )
+        semantic_db.execute(
+            "INSERT INTO semantic_answers VALUES (?, ?, ?, ?, ?, ?)",
+            (*scope, prompt, embedding.tobytes(), response, created_at)
+        )
+        semantic_db.commit()
+
+
+async def semantic_cache_set(scope, prompt, embedding, response):
+    created_at = time.time()
+    semantic_index_add(scope, embedding, response, created_at)
     try:
-        response = client.models.generate_content(
-            model="models/gemini-2.5-flash",
-            contents=prompt
+        await asyncio.to_thread(
+            _semantic_db_insert, scope, prompt, embedding, response, created_at
         )
-        return response.text
+    except sqlite3.Error:
+        # The answer is already cached in memory; only persistence failed
+        logger.exception("Could not persist semantic cache entry")
+
 
-    except Exception as e:
-        return f"LLM unavailable due to quota or rate limits. Suggested action: {USE_CASE_SOLUTIONS.get(result['use_case'], 'Manual review required.')}"
+async def embed_prompt(prompt):
+    """Return a unit-length embedding of the prompt, or None if embedding fails."""
+    try:
+        async with embedding_rate_limiter, embedding_semaphore:
+            response = await client.aio.models.embed_content(
+                model=EMBEDDING_MODEL,
+                contents=" ".join(prompt.split())
+            )
+    except Exception:
+        logger.exception("Embedding request failed; skipping the semantic cache")
+        return None
+    vector = np.asarray(response.embeddings[0].values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+async def _llm_cached(use_case, source, target, status):
+    key = (use_case, source, target, status)
+    cached = llm_cache.get(key)
+    if cached is not None and time.monotonic() - cached[0] < LLM_CACHE_TTL:
+        llm_cache.move_to_end(key)
+        return cached[1]
+
+    prompt = PROMPT_TEMPLATE.format_map(
+        {"use_case": use_case, "source": source, "target": target, "status": status}
+    )
+
+    scope = (use_case, status)
+    embedding = await embed_prompt(prompt)
+    text = semantic_cache_get(scope, embedding) if embedding is not None else None
+
+    if text is None:
+        await reserve_tokens(estimate_tokens(prompt))
+        response = await generate_with_retry(contents=prompt)
+        text = response.text
+        if embedding is not None:
+            await semantic_cache_set(scope, prompt, embedding, text)
+
+    llm_cache[key] = (time.monotonic(), text)
+    llm_cache.move_to_end(key)
+    if len(llm_cache) > LLM_CACHE_MAXSIZE:
+        llm_cache.popitem(last=False)
+    return text
+
+
+async def generate_llm_solution_async(result):
+    try:
+        return await _llm_cached(*llm_cache_key(result))
 
+    except Exception:
+        return FALLBACK_SOLUTIONS[result["use_case"]]
 
 
-def log_llm_decision(data: dict):
+
+def log_llm_frame(frame):
+    created_at = datetime.now(timezone.utc)
     with open(LOG_FILE, "a", encoding="utf-8") as f:
-        f.write(json.dumps(data, default=str) + "\n")
+        for use_case, status, severity, source, target, solution in zip(
+            frame["use_case"], frame["status"], frame["severity"],
+            frame["source"], frame["target"], frame["solution"]
+        ):
+            invalid = status == "INVALID_USE_CASE"
+            f.write(json.dumps({
+                "use_case": use_case,
+                "status": status,
+                "severity": severity,
+                "source": None if invalid else source,
+                "target": None if invalid else target,
+                "llm_output": {
+                    "model": "gemini-2.5-flash",
+                    "explanation": solution,
+                },
+                "created_at": created_at
+            }, default=str) + "\n")
+
+
+def emit_frame(frame, columns):
+    """Log the rows and serialize them as NDJSON straight from the frame."""
+    if frame.empty:
+        return b""
+    log_llm_frame(frame)
+    payload = frame[columns].to_json(orient="records", lines=True)
+    return (payload.rstrip("\n") + "\n").encode("utf-8")
 
 
 @app.post("/run-use-cases")
 async def run_use_cases(file: UploadFile = File(...)):
     try:
-        df = pd.read_csv(file.file)
+        contents = await file.read()
+        df = await asyncio.to_thread(read_upload_csv, io.BytesIO(contents))
     except Exception:
         raise HTTPException(400, "Invalid CSV format")
 
     if "use_case" not in df.columns:
         raise HTTPException(400, "use_case column missing")
 
-    results = []
-
-    for _, row in df.iterrows():
-        result = handle_use_case_row(row)
-
-        if result["status"] == "INVALID_USE_CASE":
-            result["solution"] = "Rejected: use_case not recognized."
-        elif result["use_case"] == "CSV Upload Validation":
-            result["solution"] = USE_CASE_SOLUTIONS["CSV Upload Validation"]
-        else:
-            result["solution"] = generate_llm_solution(result)
-
-        log_llm_decision({
-            "use_case": result["use_case"],
-            "status": result["status"],
-            "severity": result["severity"],
-            "source": result.get("source"),
-            "target": result.get("target"),
-            "llm_output": {
-                "model": "gemini-2.5-flash",
-                "explanation": result["solution"],
-            },
-            "created_at": datetime.now(timezone.utc)
-        })
-
-        results.append(result)
-
-    return {
-        "total": len(results),
-        "results": results
-    }
-
+    classified = classify_frame(df).assign(solution=None)
+    output_columns = RESULT_COLUMNS + ["solution"]
+
+    invalid = classified["status"].eq("INVALID_USE_CASE")
+    csv_upload = classified["use_case"].eq("CSV Upload Validation") & ~invalid
+    classified.loc[invalid, "solution"] = "Rejected: use_case not recognized."
+    classified.loc[csv_upload, "solution"] = _CSV_UPLOAD_SOLUTION
+
+    async def stream_results():
+        yield emit_frame(classified[invalid], INVALID_RESULT_COLUMNS + ["solution"])
+        yield emit_frame(classified[csv_upload], output_columns)
+
+        # One Gemini request per distinct prompt in the batch
+        llm_frame = classified[~invalid & ~csv_upload].reset_index(drop=True)
+        prompts = list(llm_frame.groupby(PROMPT_KEY_COLUMNS, sort=False).indices.items())
+
+        for start in range(0, len(prompts), LLM_BATCH_SIZE):
+            batch = prompts[start:start + LLM_BATCH_SIZE]
+            solutions = await asyncio.gather(*(
+                generate_llm_solution_async(dict(zip(PROMPT_KEY_COLUMNS, key)))
+                for key, _ in batch
+            ))
+            positions = [rows for _, rows in batch]
+            batch_frame = llm_frame.iloc[np.concatenate(positions)].copy()
+            batch_frame["solution"] = np.repeat(
+                np.array(solutions, dtype=object), [len(rows) for rows in positions]
+            )
+            yield emit_frame(batch_frame, output_columns)
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
+if __name__ == "__main__":
+    # Requires uvloop>=0.17 and httptools>=0.5 (pip install "uvicorn[standard]").
+    # Equivalent to: uvicorn app:app --workers $WEB_CONCURRENCY --loop uvloop --http httptools
+    import uvicorn
+
+    uvicorn.run(
+        "app:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        workers=WEB_CONCURRENCY,
+        loop="uvloop",
+        http="httptools",
+    )